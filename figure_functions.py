@@ -1,113 +1,245 @@
 # import packages
-import plotly.offline
-import plotly.graph_objs as go
 import numpy as np
+import pandas as pd
 import math
+import threading
+from fast_histogram import histogram1d
 
 
-# Distribution bar creation
-def create_dist(df, x_var, color, x_bar=None, interval_perc=0.1):
+# color palette as rgba strings, walked in a random order drawn once per session
+AXA_colors = ('rgba(0, 0, 143, 0.8)',
+              'rgba(252, 211, 133, 0.8)',
+              'rgba(2, 113, 128, 0.8)',
+              'rgba(225, 150, 170, 0.8)',
+              'rgba(0, 174, 198, 0.8)',
+              'rgba(145, 65, 70, 0.8)',
+              'rgba(52, 60, 61, 0.8)',
+              'rgba(181, 208, 238, 0.8)')
+_palette_order = np.random.permutation(len(AXA_colors)).tolist()
+
+
+# round the values sent to the traces to float32 precision, so they serialise to short decimals with any json engine
+def _round_sig(a, digits=7):
+    a = np.asarray(a, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mag = np.floor(np.log10(np.abs(a)))
+    scale = 10.0 ** (digits - 1 - np.where(np.isfinite(mag), mag, 0))
+    return np.round(a * scale) / scale
+
+
+# Distribution intervals creation
+def make_edges(x_arr, interval_perc=0.1):
     """
-    Function to create a bar distribution plot behind the scatter plots to acquire more information about the variables.
+    Function to create the limits of the intervals used for the distribution bars and the averages of the scatter plots.
 
-    :param df: pandas.DataFrame
-        DataFrame containing all the x values to be used for plotting.
-    :param x_var: string
-        Name of the X axis variable to be plotted.
-    :param x_bar: np.array(Default= None, has a value of there is a secondary y value to plot)
-        Array containing the limits of all the intervals for the distribution bars and for the averages to be used for the scatter plot.
-    :param color: dictionary
-        Dictionary with the rgba value of the color to use for scatter.
-    :param interval_perc: float (Default= 0.01)
+    :param x_arr: np.array
+        Array containing all the x values to be used for plotting.
+    :param interval_perc: float (Default= 0.1)
         Size of the interval in percentage to be used for the distribution plots.
-    :return trace, x_bar: plotly.graph_objs, np.array
-        Plotly bar plot witht the distribution of the variable to be plotted.
+    :return x_bar: np.array
         Array containing the limits of all the intervals for the distribution bars and for the averages to be used for the scatter plot.
     """
-    if x_bar is None:
-        # make interval
-        temp = math.ceil(df[x_var].max() / 100)
-        interval = interval_perc * temp
+    # make interval, missing values are ignored like pandas' max does
+    vmax = np.nanmax(x_arr)
+    temp = math.ceil(vmax / 100)
+    interval = interval_perc * temp
+
+    # Create zones, with an integer count of edges so they stay exactly uniform
+    # as many edges as np.arange(0, temp * 100 + temp, interval) gives, the small epsilon absorbing float error
+    n_edges = math.ceil((temp * 100 + temp) / interval - 1e-9)
+    # and at least enough for the last edge to lie strictly above the max, the histograms exclude the last edge
+    n_edges = max(n_edges, math.floor(vmax / interval) + 2)
+    x_bar = np.linspace(0, (n_edges - 1) * interval, n_edges)
 
-        # Create zones
-        x_bar = np.arange(0, math.ceil(df[x_var].max() / 100) * 100 + temp, interval)
+    return x_bar
 
+
+# Distribution bar creation
+def dist_trace(x_arr, x_bar, color, var_name):
+    """
+    Function to create a bar distribution plot behind the scatter plots to acquire more information about the variables.
+
+    :param x_arr: np.array
+        Array containing all the values of the variable to be plotted.
+    :param x_bar: np.array
+        Array containing the limits of all the intervals for the distribution bars, as returned by make_edges.
+    :param color: dictionary
+        Dictionary with the rgba value of the color to use for the bars.
+    :param var_name: string
+        Name of the variable to be plotted.
+    :return trace: dict
+        Plotly bar trace with the distribution of the variable to be plotted.
+    """
     # Divide by zones
-    count = np.histogram(df[x_var], x_bar)[0]
+    # x_bar is uniform so the bins/range form of the histogram is exact
+    count = histogram1d(x_arr, bins=len(x_bar) - 1, range=(x_bar[0], x_bar[-1]))
 
-    y_bar = (count * 100 / len(df)) * 0.01
+    y_bar = _round_sig(count / len(x_arr))
 
-    trace = go.Bar({
+    trace = {
+        'type': 'bar',
         'x': x_bar,
         'y': y_bar,
         'marker': color,
         'opacity': 0.3,
-        'name': 'Dist. ' + str(x_var)
-    })
+        'name': 'Dist. ' + str(var_name)
+    }
 
-    return trace, x_bar
+    return trace
 
 
-# create a category column to sort and average
-def cat_clients(df, x_var, x_bar):
+# create a category array to sort and average
+def compute_cat(x_arr, x_bar):
     """
-    Function that creates a columns to categories the values according to the distribution interval they lie in.
+    Function that categorises the values according to the distribution interval they lie in.
 
-    :param df: pandas.DataFrame
-        DataFrame containing all the x values to be used for plotting.
-    :param x_var: string
-        Name of the X axis variable to be plotted.
+    :param x_arr: np.array
+        Array containing all the x values to be used for plotting.
     :param x_bar: np.array
         Array containing the limits of all the intervals for the distribution bars and for the averages to be used for the scatter plot.
-    :return df: pandas.DataFrame
-        Returns the DataFrame with a 'cat' column to separate the variable values according to their respective intervals for the distribution bars.
+    :return cats: np.array
+        Array of the interval index of every value, to separate the variable values according to their respective intervals for the distribution bars.
     """
-    criteria = []
-    for i in range(len(x_bar) - 1):
-        criteria.append(df[x_var].between(x_bar[i], x_bar[i + 1]))
-    values = np.arange(0, len(x_bar) - 1)
-
-    df['cat'] = np.select(criteria, values, 0)
+    # index of the interval each value lies in, out of range values go to the edge intervals
+    # same arithmetic as the kernels so both paths put every value in the same interval
+    # missing values are put in the first interval, callers leave them out of their sums
+    step = x_bar[1] - x_bar[0]
+    cats = np.floor((x_arr - x_bar[0]) / step)
+    np.clip(cats, 0, len(x_bar) - 2, out=cats)
+    cats = np.nan_to_num(cats, copy=False).astype(np.intp)
 
-    return df
+    return cats
 
 
 # Set x and y of scatter to the average per interval
-def avg_cats(df, x_var, y_var):
-    df = df.sort_values(by=['pr_total'])
-
-    x = df.groupby(['cat'])[x_var].mean()
-    y = df.groupby(['cat'])[y_var].mean()
+def avg_cats(cat_codes, x_arr, y_arr):
+    """
+    Function that averages the x and y values per distribution interval.
+
+    :param cat_codes: np.array
+        Array of the interval index of every value, as returned by compute_cat.
+    :param x_arr: np.array
+        Array containing all the x values to be used for plotting.
+    :param y_arr: np.array
+        Array containing all the y values to be used for plotting.
+    :return x, y: np.array, np.array
+        Averages of the x and y values for every non empty interval, ordered by interval.
+    """
+    # sums and counts per interval in one pass each, without the missing values of each variable
+    finite_x = np.isfinite(x_arr)
+    finite_y = finite_x & np.isfinite(y_arr)
+    counts_x = np.bincount(cat_codes[finite_x])
+    counts_y = np.bincount(cat_codes[finite_y], minlength=len(counts_x))
+    sums_x = np.bincount(cat_codes[finite_x], weights=x_arr[finite_x])
+    sums_y = np.bincount(cat_codes[finite_y], weights=y_arr[finite_y], minlength=len(counts_x))
+
+    # empty intervals are dropped
+    mask = counts_y > 0
+
+    x = _round_sig(sums_x[mask] / counts_x[mask])
+    y = _round_sig(sums_y[mask] / counts_y[mask])
     return x, y
 
 
+# numeric kernels, ahead of time compiled when vh_kernels has been built by running kernels.py,
+# otherwise jitted on first use and cached on disk so later sessions skip the compilation
+try:
+    from vh_kernels import bin_mean as _bin_and_mean
+except ImportError:
+    import numba
+    import kernels
+    _bin_and_mean = numba.njit(cache=True)(kernels.bin_mean)
+
+
+class _WorkBuffers(threading.local):
+    """
+    Scratch arrays of the kernels kept per thread, so figures rendered again and again reuse them instead of allocating.
+    Only arrays up to max_size elements are kept, larger ones are allocated for the call and freed with it.
+    """
+
+    def __init__(self, max_size=2 ** 21):
+        self.max_size = max_size
+        self.arrays = {}
+
+    def get(self, name, shape, dtype):
+        # grow the named buffer only when it is too small, and hand out a view of the requested shape
+        size = int(np.prod(shape))
+        if size > self.max_size:
+            return np.empty(shape, dtype)
+        buf = self.arrays.get(name)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            buf = np.empty(size, dtype)
+            self.arrays[name] = buf
+        return buf[:size].reshape(shape)
+
+    def clear(self):
+        # release every buffer kept by the current thread
+        self.arrays = {}
+
+
+_work_buffers = _WorkBuffers()
+
+
+def avg_intervals_multi(x_arr, y_arrs, x_bar):
+    """
+    Function that averages the x values and one or several y variables per distribution interval.
+
+    :param x_arr: np.array
+        Array containing all the x values to be used for plotting.
+    :param y_arrs: list
+        List of the arrays of every y variable to be averaged, all of the same length as x_arr.
+    :param x_bar: np.array
+        Array containing the limits of all the intervals, must be uniformly spaced.
+    :return averages: list
+        List of the x and y averages of every y variable, for the intervals where that variable has values.
+    """
+    n_bins = len(x_bar) - 1
+    x_arr = np.asarray(x_arr, dtype=np.float64)
+    x_bar = np.asarray(x_bar, dtype=np.float64)
+    count = _work_buffers.get('counts', (n_bins,), np.int64)
+    x = _work_buffers.get('sum_x', (n_bins,), np.float64)
+    count_y = _work_buffers.get('counts_y', (n_bins,), np.int64)
+    y = _work_buffers.get('sum_y', (n_bins,), np.float64)
+
+    averages = []
+    for y_arr in y_arrs:
+        # every y variable is binned and averaged together with x in one pass
+        _bin_and_mean(x_arr, np.asarray(y_arr, dtype=np.float64), x_bar, count, x, count_y, y)
+        # masking copies the results out of the buffers, keeping the intervals where the variable has values
+        mask = count_y > 0
+        averages.append((_round_sig(x[mask]), _round_sig(y[mask])))
+    return averages
+
+
 def create_scatter(x, y, var_name, color, axis_num=1):
     """
 
-    :param x: Series
-        Series of the different averages of the variable x to be scattered.
-    :param y: Series
-        Series of the different averages of the variable y to be scattered.
+    :param x: np.array
+        Array of the different averages of the variable x to be scattered.
+    :param y: np.array
+        Array of the different averages of the variable y to be scattered.
     :param var_name: string
         Name of the variable to be plotted.
     :param color: dictionary
         Dictionary with the rgba value of the color to use for scatter.
     :param axis_num: integer (Default=1)
         Adds number of the y axis for overlaying purposes if a secondary y variable is desired.
-    :return trace: plotly.graph_objs
-        Data of the Scatter plot for the x and y axis variables.
-    """
-    trace = go.Scatter(
-        x=x,
-        y=y,
-        mode="lines+markers",
-        marker=color,
-        name=str(var_name),
-        yaxis='y{}'.format(axis_num))
+    :return trace: dict
+        Plotly scatter trace with the data of the Scatter plot for the x and y axis variables.
+    """
+    trace = {
+        'type': 'scatter',
+        'x': x,
+        'y': y,
+        'mode': 'lines+markers',
+        'marker': color,
+        'name': str(var_name),
+        'yaxis': 'y{}'.format(axis_num)
+    }
     return trace
 
 
-def create_cat_plots(df, categorical_var, x_var, y_var, x_bar, color_used):
+def create_cat_plots(df, categorical_var, x_arr, y_arr, cat_codes, x_bar, color_used):
     """
     Function to create the scatter and distribution bar plots for the categorical variable if necessary.
 
@@ -115,10 +247,12 @@ def create_cat_plots(df, categorical_var, x_var, y_var, x_bar, color_used):
         DataFrame with the values of the categorical variable.
     :param categorical_var: string
         Name of the categorical variable desired.
-    :param x_var: string
-        Name of the X axis variable plotted.
-    :param y_var: string
-        Name of the Y axis variable plotted.
+    :param x_arr: numpy.array
+        Array of the X axis variable values plotted.
+    :param y_arr: numpy.array
+        Array of the Y axis variable values plotted.
+    :param cat_codes: numpy.array
+        Array of the interval index of every X value, as returned by compute_cat.
     :param x_bar: numpy.array
         Array containing the limits of all the intervals for the distribution bars and for the averages to be used for the scatter plot.
     :param color_used: list
@@ -127,25 +261,49 @@ def create_cat_plots(df, categorical_var, x_var, y_var, x_bar, color_used):
         List of the bar and scatter plot for the categorical variable to be plotted.
         List of the indexes of the colors already used in the graph - updated.
     """
-    temp_cat_x = df.groupby([categorical_var, 'cat'])[x_var].mean()
-    temp_cat_y = df.groupby([categorical_var, 'cat'])[y_var].mean()
+    # combine the category code and the interval into a single key to average with one bincount
+    codes, uniques = pd.factorize(df[categorical_var])
+    n_bins = len(x_bar) - 1
+    # rows missing a category or x are dropped, a missing y only drops it from the y averages
+    valid = (codes >= 0) & np.isfinite(x_arr)
+    key = codes[valid] * n_bins + cat_codes[valid]
+    size = len(uniques) * n_bins
+    finite_y = np.isfinite(y_arr[valid])
+
+    counts = np.bincount(key, minlength=size).reshape(len(uniques), n_bins)
+    counts_y = np.bincount(key[finite_y], minlength=size).reshape(len(uniques), n_bins)
+    sums_x = np.bincount(key, weights=x_arr[valid], minlength=size).reshape(len(uniques), n_bins)
+    sums_y = np.bincount(key[finite_y], weights=y_arr[valid][finite_y], minlength=size).reshape(len(uniques), n_bins)
+
+    # per category distribution from the same counts, without the values clipped into the edge intervals
+    dist = counts.copy()
+    x_valid = x_arr[valid]
+    dist[:, 0] -= np.bincount(codes[valid][x_valid < x_bar[0]], minlength=len(uniques))
+    dist[:, -1] -= np.bincount(codes[valid][x_valid >= x_bar[-1]], minlength=len(uniques))
 
     trace_cats = []
-    for v in df[categorical_var].unique():
-        temp_x = temp_cat_x[v]
-        temp_y = temp_cat_y[v]
+    for i, v in enumerate(uniques):
+        mask = counts_y[i] > 0
+        temp_x = _round_sig(sums_x[i][mask] / counts[i][mask])
+        temp_y = _round_sig(sums_y[i][mask] / counts_y[i][mask])
 
-        count = np.histogram(df[df[categorical_var] == v][x_var], x_bar)[0]
-        y_bar = (count * 100 / len(df)) * 0.01
+        y_bar = _round_sig(dist[i] / len(x_arr))
         color, color_used = find_color(color_used)
 
-        trace_cats += [create_scatter(temp_x, temp_y, v, color), go.Bar({
+        # both traces of a category share its legend entry
+        scatter = create_scatter(temp_x, temp_y, v, color)
+        scatter['legendgroup'] = str(v)
+
+        trace_cats += [scatter, {
+            'type': 'bar',
             'x': x_bar,
             'y': y_bar,
             'marker': color,
             'opacity': 0.3,
-            'name': str(v)
-        })]
+            'name': str(v),
+            'legendgroup': str(v),
+            'showlegend': False
+        }]
 
     return trace_cats, color_used
 
@@ -159,28 +317,18 @@ def find_color(color_used):
         Dictionary of the rgba of the color to set to the plot at hand.
         List of the indexes of colors already used - updated with new color
     """
-    AXA_colors = [(0, 0, 143, 0.8),
-                  (252, 211, 133, 0.8),
-                  (2, 113, 128, 0.8),
-                  (225, 150, 170, 0.8),
-                  (0, 174, 198, 0.8),
-                  (145, 65, 70, 0.8),
-                  (52, 60, 61, 0.8),
-                  (181, 208, 238, 0.8)]
+    # colors are taken in the shuffled palette order, starting over once they have all been used
+    temp = _palette_order[len(color_used) % len(AXA_colors)]
 
-    temp = np.random.randint(0, 8)
-
-    while temp in color_used:
-        temp = np.random.randint(0, 8)
-
-    color = dict(color='rgba' + str(AXA_colors[temp]))
+    color = dict(color=AXA_colors[temp])
 
     color_used.append(temp)
 
     return color, color_used
 
 
-def create_figure(df, x_var, y_var, x_title, y_title, title, second_y_var=None, categorical_var=None, stack_bar=False):
+def create_figure(df, x_var, y_var, x_title, y_title, title, second_y_var=None, categorical_var=None, stack_bar=False,
+                  filename=None):
     """
     Function that creates the final figure, appending all the data and layout together.
 
@@ -202,10 +350,22 @@ def create_figure(df, x_var, y_var, x_title, y_title, title, second_y_var=None,
         Name of the categorical variable that can also be mapped for comparison
     :param stack_bar: bool (Default=False)
         Sets distribution histograms as stacks
-    :return: plotly.offline.plot
-        Returns the plot as an html file in outputs and opens in the default browser
+    :param filename: string (Default=None)
+        Path of the html file to write, defaults to the title of the graph in the working directory
+    :return filename: string
+        Path of the html file the plot was written to, which is also opened in the default browser
     """
 
+    # plotly is only needed to render, import it here to keep the helpers light to import
+    import plotly.io
+
+    # extract the plotted columns once
+    x_arr = df[x_var].to_numpy()
+    y_arr = df[y_var].to_numpy()
+    y_arrs = [y_arr]
+    if second_y_var is not None:
+        y_arrs.append(df[second_y_var].to_numpy())
+
     # memory of color used
     color_used = []
 
@@ -213,12 +373,13 @@ def create_figure(df, x_var, y_var, x_title, y_title, title, second_y_var=None,
     color, color_used = find_color(color_used)
 
     # prepare scatter and dist plots
-    trace_bar, x_bar = create_dist(df, x_var, color)
+    x_bar = make_edges(x_arr)
+    trace_bar = dist_trace(x_arr, x_bar, color, x_var)
 
-    df = cat_clients(df, x_var, x_bar)
-    x, y = avg_cats(df, x_var, y_var)
+    # average every y variable over the same intervals at once
+    averages = avg_intervals_multi(x_arr, y_arrs, x_bar)
 
-    trace_scatter = create_scatter(x, y, x_var, color)
+    trace_scatter = create_scatter(*averages[0], x_var, color)
 
     # set stack
     if stack_bar is True:
@@ -236,10 +397,9 @@ def create_figure(df, x_var, y_var, x_title, y_title, title, second_y_var=None,
 
     # create second y variable scatter if necessary
     if second_y_var is not None:
-        x2, y2 = avg_cats(df, x_var, second_y_var)
         color2, color_used = find_color(color_used)
-        trace_scatter2 = create_scatter(x2, y2, second_y_var, color2, 2)
-        trace_bar2, x_bar = create_dist(df, second_y_var, color2, x_bar)
+        trace_scatter2 = create_scatter(*averages[1], second_y_var, color2, 2)
+        trace_bar2 = dist_trace(y_arrs[1], x_bar, color2, second_y_var)
         data += [trace_scatter2, trace_bar2]
         layout['yaxis2'] = dict(title=second_y_var,
                                 overlaying='y1',
@@ -247,9 +407,15 @@ def create_figure(df, x_var, y_var, x_title, y_title, title, second_y_var=None,
 
     # add categorical plots if not none
     if categorical_var is not None:
-        trace_cats, color_used = create_cat_plots(df, categorical_var, x_var, y_var, x_bar, color_used)
+        cat_codes = compute_cat(x_arr, x_bar)
+        trace_cats, color_used = create_cat_plots(df, categorical_var, x_arr, y_arr, cat_codes, x_bar, color_used)
         data += trace_cats
 
-    return plotly.offline.plot({"data": data, "layout": layout},
-                               filename=r"C:\Users\a-garde\PycharmProjects\Plotly-Graph\output_file\{}.html".format(
-                                   title))
+    if filename is None:
+        filename = '{}.html'.format(title)
+
+    # traces are plain dicts so skip validation, and link plotly.js instead of inlining it
+    plotly.io.write_html({"data": data, "layout": layout}, file=filename, include_plotlyjs='cdn', validate=False,
+                         auto_open=True)
+
+    return filename
@@ -0,0 +1,41 @@
+# import packages
+import math
+
+# numeric kernels as plain functions, jitted by figure_functions, or compiled ahead of time with: python kernels.py
+# values are binned like figure_functions.compute_cat does, values out of the edges going to the edge intervals
+# rows with a missing or infinite value are left out of the averages of that variable, like pandas' mean does
+
+
+# Fused binning and averaging over uniform intervals, written into the given count and mean arrays
+def bin_mean(x, y, edges, cnt, sx, cnt_y, sy):
+    nb = edges.size - 1
+    cnt[:] = 0
+    sx[:] = 0
+    cnt_y[:] = 0
+    sy[:] = 0
+    lo, step = edges[0], edges[1] - edges[0]
+    for i in range(x.size):
+        if not math.isfinite(x[i]):
+            continue
+        b = min(max(math.floor((x[i] - lo) / step), 0), nb - 1)
+        cnt[b] += 1
+        sx[b] += x[i]
+        if math.isfinite(y[i]):
+            cnt_y[b] += 1
+            sy[b] += y[i]
+    for b in range(nb):
+        if cnt[b] > 0:
+            sx[b] /= cnt[b]
+        if cnt_y[b] > 0:
+            sy[b] /= cnt_y[b]
+
+
+if __name__ == '__main__':
+    # build the vh_kernels extension next to the sources, figure_functions picks it up when it is importable
+    import os
+    from numba.pycc import CC
+
+    cc = CC('vh_kernels')
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+    cc.export('bin_mean', 'void(f8[:], f8[:], f8[:], i8[:], f8[:], i8[:], f8[:])')(bin_mean)
+    cc.compile()